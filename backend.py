@@ -1,23 +1,31 @@
-from fastapi import FastAPI, File, UploadFile, Form, HTTPException, BackgroundTasks
+from fastapi import FastAPI, File, UploadFile, Form, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
+import asyncio
 import uuid
 import os
+import shutil
 from contextlib import asynccontextmanager
 import uvicorn
 import logging
 
-from conversation_controller import ConversationController
+# The only logging configuration for the app; routine per-chunk messages are DEBUG, so set LOG_LEVEL=INFO or DEBUG to see them.
+logging.basicConfig(level=os.getenv("LOG_LEVEL", "WARNING").upper())
 
-controller = ConversationController()
+from conversation_controller import ConversationController, SessionState
 
-logging.basicConfig(level=logging.INFO)
+# With REDIS_URL set, conversation state is shared through Redis so any worker can serve any session.
+if os.getenv("REDIS_URL"):
+    from conversation_store import RedisConversationStore
+    controller = ConversationController(store=RedisConversationStore(os.environ["REDIS_URL"]))
+else:
+    controller = ConversationController()
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     logging.info("Application startup: Starting background conversion.")
-    controller.start_background_conversion(check_interval=5, parallel_limit=10)
-    controller.start_background_whisper_conversion(check_interval=5, parallel_limit=10)
+    controller.start_background_conversion(parallel_limit=10)
+    controller.start_background_whisper_conversion(parallel_limit=10)
     controller.start_background_category_conversion(parallel_limit=5)
     logging.info("Background conversion thread started.")
     yield
@@ -35,32 +43,59 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Dictionary to track processed chunks for each session.
-# Structure: { session_id: set(chunk_numbers) }
-received_chunks = {}
-
-def save_audio(audio_bytes: bytes, session_id: str, chunk_number: int, chunk_type: str):
-    """Save the received audio chunk to the 'uploads' subfolder without converting the format."""
+# Size of the blocks read from the upload and written to disk.
+UPLOAD_READ_SIZE = 64 * 1024
+
+# Keeps references to fire-and-forget tasks so they are not garbage collected mid-flight.
+background_tasks = set()
+
+def copy_upload(source, filepath: str) -> int:
+    """
+    Copy an upload's spooled file to filepath in UPLOAD_READ_SIZE blocks.
+    An empty upload leaves no file behind. Returns the number of bytes written.
+    """
+    with open(filepath, 'wb') as f:
+        shutil.copyfileobj(source, f, UPLOAD_READ_SIZE)
+        size = f.tell()
+    if size == 0:
+        os.unlink(filepath)
+    return size
+
+def log_handle_chunk_failure(task: asyncio.Task, session_id: str, chunk_number: int):
+    """Done-callback logging a handle_chunk task that raised, since nothing else awaits it."""
+    if not task.cancelled() and task.exception() is not None:
+        logging.error("Error handling chunk %d for session %s: %s", chunk_number, session_id, task.exception())
+
+async def save_audio(audio: UploadFile, session_id: str, chunk_number: int, chunk_type: str):
+    """
+    Stream the received audio chunk to the 'uploads' subfolder without converting the format,
+    then hand it to the controller on a worker thread. Raises if the chunk could not be saved.
+    """
     try:
-        if len(audio_bytes) == 0:
-            logging.warning("Received empty audio data for session %s, chunk %d. Skipping save.", session_id, chunk_number)
-            return
         uploads_dir = "uploads"
         os.makedirs(uploads_dir, exist_ok=True)
         filename = f"{session_id}_chunk{chunk_number}_{chunk_type}_{uuid.uuid4().hex}.webm"
         filepath = os.path.join(uploads_dir, filename)
-        with open(filepath, 'wb') as f:
-            f.write(audio_bytes)
-        logging.info("Saved file: %s (size: %d bytes)", filepath, len(audio_bytes))
-        controller.handle_chunk(
-            session_id=session_id, 
+        # The whole copy runs in a single worker-thread hop rather than one hop per block.
+        size = await asyncio.to_thread(copy_upload, audio.file, filepath)
+        if size == 0:
+            logging.warning("Received empty audio data for session %s, chunk %d. Skipping save.", session_id, chunk_number)
+            return
+        logging.debug("Saved file: %s (size: %d bytes)", filepath, size)
+        task = asyncio.create_task(asyncio.to_thread(
+            controller.handle_chunk,
+            session_id=session_id,
             chunk_number=chunk_number,
-            chunk_file_path=filepath, 
-            chunk_name=filename, 
+            chunk_file_path=filepath,
+            chunk_name=filename,
             chunk_type=chunk_type
-        )
+        ))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+        task.add_done_callback(lambda task: log_handle_chunk_failure(task, session_id, chunk_number))
     except Exception as e:
         logging.error("Error saving audio for session %s chunk %d: %s", session_id, chunk_number, e)
+        raise
 
 @app.get("/")
 def read_root():
@@ -103,7 +138,6 @@ async def conversation_status(conversation_id):
 
 @app.post("/upload_audio")
 async def upload_audio(
-    background_tasks: BackgroundTasks,
     audio: UploadFile = File(...),
     session_id: str = Form(...),
     chunk_number: int = Form(...),
@@ -112,24 +146,24 @@ async def upload_audio(
     if not audio:
         raise HTTPException(status_code=400, detail="No audio file provided")
     
-    # Initialize session tracking if needed.
-    if session_id not in received_chunks:
-        received_chunks[session_id] = set()
-    
-    # If this chunk has already been processed, return a duplicate response.
-    if chunk_number in received_chunks[session_id]:
-        return JSONResponse(content={"status": "duplicate", "message": "Chunk already processed"})
+    # Initialize session tracking if needed; the controller owns the per-session state.
+    state = controller.received_chunks.setdefault(session_id, SessionState())
     
-    # Mark the chunk as received.
-    received_chunks[session_id].add(chunk_number)
+    async with state.lock:
+        # Mark the chunk as received; if it has already been processed, return a duplicate response.
+        if not state.add(chunk_number):
+            return JSONResponse(content={"status": "duplicate", "message": "Chunk already processed"})
     
     try:
-        # Read the uploaded audio data.
-        audio_bytes = await audio.read()
-        
-        # Schedule saving the audio in the background.
-        background_tasks.add_task(save_audio, audio_bytes, session_id, chunk_number, chunk_type)
-        
+        # Stream the uploaded audio data to disk.
+        await save_audio(audio, session_id, chunk_number, chunk_type)
+    except Exception as e:
+        # Forget the chunk so the client can retry it instead of being told it is a duplicate.
+        async with state.lock:
+            state.remove(chunk_number)
+        raise HTTPException(status_code=500, detail=f"Could not save chunk: {e}")
+
+    try:
         response_data = {
             "status": "accepted",
             "session_id": session_id,
@@ -140,14 +174,20 @@ async def upload_audio(
         # If this is the final chunk, check that all expected chunks have been received.
         if chunk_type.lower() == "final":
             # Assume chunk numbering starts at 0; hence final chunk's number + 1 is the total expected.
-            expected_chunks = set(range(chunk_number + 1))
-            if received_chunks[session_id] == expected_chunks:
-                del received_chunks[session_id]
-                response_data["cleanup"] = "session cleaned up"
-            else:
-                missing = sorted(list(expected_chunks - received_chunks[session_id]))
-                response_data["cleanup"] = f"not cleaned up, missing chunks: {missing}"
-                #TODO - Find a way to handle it so it waits in case the final chunk arrives before every chunk has been recieved.
+            async with state.lock:
+                complete = state.is_complete(chunk_number)
+                if not complete:
+                    missing = state.get_missing(chunk_number)
+                    if missing and controller.has_store:
+                        # Chunks missing here may have been uploaded to another worker.
+                        missing = await asyncio.to_thread(controller.filter_stored_chunks, session_id, missing)
+                        complete = not missing
+                if complete:
+                    controller.received_chunks.pop(session_id, None)
+                    response_data["cleanup"] = "session cleaned up"
+                else:
+                    response_data["cleanup"] = f"not cleaned up, missing chunks: {missing}"
+                    #TODO - Find a way to handle it so it waits in case the final chunk arrives before every chunk has been recieved.
         return JSONResponse(content=response_data)
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
@@ -157,4 +197,24 @@ async def upload_audio(
 
 if __name__ == "__main__":
     import uvicorn
-    uvicorn.run("backend:app", host="127.0.0.1", port=8888, reload=True)
+    # Requires the uvloop and httptools packages.
+    if os.getenv("DEV") == "1":
+        # Auto-reload watches the filesystem, so it is only enabled for local development.
+        uvicorn.run("backend:app", host="127.0.0.1", port=8888, reload=True, loop="uvloop", http="httptools")
+    else:
+        # Each worker process has its own controller, so several workers only see each other's sessions
+        # through the Redis store.
+        workers = int(os.getenv("WEB_CONCURRENCY", 4 if os.getenv("REDIS_URL") else 1))
+        if workers > 1 and not os.getenv("REDIS_URL"):
+            raise SystemExit("WEB_CONCURRENCY > 1 requires REDIS_URL so the workers share conversation state.")
+        uvicorn.run(
+            "backend:app",
+            host=os.getenv("HOST", "0.0.0.0"),
+            port=8888,
+            workers=workers,
+            limit_concurrency=200,
+            backlog=512,
+            timeout_keep_alive=5,
+            loop="uvloop",
+            http="httptools"
+        )
@@ -0,0 +1,55 @@
+"""
+Celery application running the long-running media and inference work outside the web process.
+
+Enabled by setting TASK_BACKEND=celery for the API; start workers with:
+    celery -A celery_app worker --loglevel=info
+
+Workers need the same REDIS_URL and access to the same 'uploads' and 'converted_wav' folders as the API,
+since tasks are passed file paths rather than file contents.
+"""
+import os
+from celery import Celery
+from utils.convert_all_formats_to_wav import AudioConverter
+from utils.api import whisper, llama
+
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+
+celery_app = Celery("stream_test", broker=REDIS_URL, backend=REDIS_URL)
+celery_app.conf.update(
+    task_serializer="json",
+    result_serializer="json",
+    accept_content=["json"],
+    # Only acknowledge once a task has finished so a crashed worker's job is redelivered,
+    # and fetch one task at a time since every task is long-running.
+    task_acks_late=True,
+    worker_prefetch_multiplier=1,
+)
+
+
+@celery_app.task(bind=True, max_retries=3)
+def wav_convert_task(self, file_path, output_folder="converted_wav", trim_silence=False):
+    """Converts file_path to WAV in output_folder and returns the WAV path."""
+    try:
+        converter = AudioConverter(input_file=file_path, output_folder=output_folder, trim_silence=trim_silence)
+        _, output_file, _, _ = converter()
+        return output_file
+    except Exception as e:
+        raise self.retry(exc=e, countdown=2)
+
+
+@celery_app.task(bind=True, max_retries=3)
+def whisper_task(self, file_path):
+    """Returns the Whisper transcription of file_path (None if the API gave no text)."""
+    try:
+        return whisper(file_path)
+    except Exception as e:
+        raise self.retry(exc=e, countdown=2)
+
+
+@celery_app.task(bind=True, max_retries=3)
+def llama_task(self, prompt):
+    """Returns the Llama categorization response for a single prompt."""
+    try:
+        return llama(prompt)
+    except Exception as e:
+        raise self.retry(exc=e, countdown=2)
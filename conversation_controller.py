@@ -1,12 +1,130 @@
 import uuid
+import asyncio
 import concurrent.futures
+import multiprocessing
+import os
+import queue
 import threading
-import time
 import logging
+from dataclasses import dataclass, field
 from utils.convert_all_formats_to_wav import AudioConverter
 from utils.api import whisper, llama
 
-logging.basicConfig(level=logging.INFO)
+# "local" runs conversions in this process; "celery" sends them to the workers in celery_app.py.
+TASK_BACKEND = os.getenv("TASK_BACKEND", "local")
+# Seconds to wait for a Celery task result before treating the task as failed.
+TASK_TIMEOUT = int(os.getenv("TASK_TIMEOUT", 600))
+if TASK_BACKEND == "celery":
+    import celery_app
+else:
+    celery_app = None
+# Number of processes used for local WAV conversion. 0 keeps conversion on the worker threads, which is
+# enough while AudioConverter only waits on ffmpeg subprocesses; raise it if the Python-side work holds the GIL.
+WAV_PROCESS_WORKERS = max(0, min(int(os.getenv("WAV_PROCESS_WORKERS", 0)), 8))
+# Set TRIM_SILENCE=1 to strip silences from the WAV files before they are sent to Whisper.
+TRIM_SILENCE = os.getenv("TRIM_SILENCE", "0") == "1"
+
+@dataclass
+class SessionState:
+    """
+    Upload bookkeeping for a single session, used by the API to deduplicate chunks.
+
+    Attributes:
+        numbers (set): Chunk numbers received so far.
+        max_seen (int): Highest chunk number received so far (-1 if none).
+        lock (asyncio.Lock): Serialises dedupe/add/cleanup for the session.
+    """
+    numbers: set = field(default_factory=set)
+    max_seen: int = -1
+    lock: asyncio.Lock = field(default_factory=asyncio.Lock)
+
+    def add(self, chunk_number: int) -> bool:
+        """Records a chunk number. Returns False if it was already received."""
+        if chunk_number in self.numbers:
+            return False
+        self.numbers.add(chunk_number)
+        if chunk_number > self.max_seen:
+            self.max_seen = chunk_number
+        return True
+
+    def remove(self, chunk_number: int):
+        """Forgets a chunk number, e.g. when its upload could not be saved."""
+        self.numbers.discard(chunk_number)
+        if chunk_number == self.max_seen:
+            self.max_seen = max(self.numbers, default=-1)
+
+    def is_complete(self, final_chunk_number: int) -> bool:
+        """Returns True if exactly chunks 0..final_chunk_number have been received."""
+        return len(self.numbers) == final_chunk_number + 1 and self.max_seen == final_chunk_number
+
+    def get_missing(self, final_chunk_number: int):
+        """Returns a sorted list of chunk numbers missing up to final_chunk_number."""
+        return [n for n in range(final_chunk_number + 1) if n not in self.numbers]
+
+
+# Maximum number of concurrent llama requests made by a single categorize() call.
+LLAMA_PARALLEL_LIMIT = 8
+# Seconds after which a process's claim on categorizing a stored session expires.
+CATEGORY_CLAIM_TIMEOUT = 300
+
+_wav_process_pool = None
+_wav_process_pool_lock = threading.Lock()
+
+def _get_wav_process_pool():
+    """Returns the shared WAV conversion process pool, creating it on first use."""
+    global _wav_process_pool
+    with _wav_process_pool_lock:
+        if _wav_process_pool is None:
+            # The pool is created from a worker thread of a multithreaded server, where forking could copy
+            # locks held by other threads into the children, so start them from a fresh server process instead.
+            _wav_process_pool = concurrent.futures.ProcessPoolExecutor(
+                max_workers=WAV_PROCESS_WORKERS, mp_context=multiprocessing.get_context("forkserver")
+            )
+        return _wav_process_pool
+
+def _shutdown_wav_process_pool():
+    """Shuts down the WAV conversion process pool if it was started."""
+    global _wav_process_pool
+    with _wav_process_pool_lock:
+        if _wav_process_pool is not None:
+            _wav_process_pool.shutdown(wait=True)
+            _wav_process_pool = None
+
+def _convert_file_to_wav(file_path):
+    """Runs AudioConverter on file_path; top-level so it can be sent to the process pool."""
+    converter = AudioConverter(input_file=file_path, output_folder="converted_wav", trim_silence=TRIM_SILENCE)
+    _, converted_path, _, _ = converter()  # __call__ returns (input_file, output_file, output_folder, output_file_name).
+    return converted_path
+
+def _convert_to_wav(file_path):
+    """Converts file_path to WAV in 'converted_wav' and returns the WAV path."""
+    if celery_app is not None:
+        return celery_app.wav_convert_task.delay(file_path, trim_silence=TRIM_SILENCE).get(timeout=TASK_TIMEOUT)
+    if WAV_PROCESS_WORKERS > 0:
+        return _get_wav_process_pool().submit(_convert_file_to_wav, file_path).result()
+    return _convert_file_to_wav(file_path)
+
+def _whisper(file_path):
+    """Returns the Whisper transcription of file_path."""
+    if celery_app is not None:
+        return celery_app.whisper_task.delay(file_path).get(timeout=TASK_TIMEOUT)
+    return whisper(file_path)
+
+def _llama(prompt):
+    """Returns the Llama response for prompt."""
+    if celery_app is not None:
+        return celery_app.llama_task.delay(prompt).get(timeout=TASK_TIMEOUT)
+    return llama(prompt)
+
+def _safe_llama(prompt):
+    """Calls llama() on a single prompt, returning "Error" instead of raising."""
+    try:
+        logging.debug("Sending categorization prompt: %s", prompt)
+        return _llama(prompt)
+    except Exception as e:
+        logging.error("Error categorizing prompt '%s': %s", prompt, e)
+        return "Error"
+
 
 class Conversation:
     """
@@ -18,16 +136,30 @@ class Conversation:
             - file_path: The path where the chunk file is stored.
             - file_name: The name of the chunk file.
             - chunk_type: The type of the chunk ("first", "middle", or "final").
+            - wav_file_path: The converted WAV file, once WAV conversion has produced one.
         final_chunk_received (bool): Indicates whether the final chunk has been received.
+        pending_wav (int): Number of chunks not yet converted to WAV.
+        pending_whisper (int): Number of chunks not yet processed by Whisper.
+        converted_count (int): Number of chunks successfully converted to WAV.
+        whisper_count (int): Number of chunks successfully processed by Whisper.
     """
     def __init__(self, conversation_id: str):
         self.conversation_id = conversation_id
         self.chunks = {}  
         self.final_chunk_received = False
         self.category_results = []  # Each element: {"prompt": ..., "result": ...}
-
-    def add_chunk(self, chunk_number: int, chunk_file_path: str, chunk_name: str, chunk_type: str):
-        self.chunks[chunk_number] = {
+        # Live counters so pending checks never have to scan self.chunks.
+        self.pending_wav = 0
+        self.pending_whisper = 0
+        self.converted_count = 0
+        self.whisper_count = 0
+        self._categorized_count = None  # Whisper-processed chunk count at the last categorize().
+        self._counter_lock = threading.Lock()
+
+    @staticmethod
+    def new_chunk(chunk_file_path: str, chunk_name: str, chunk_type: str) -> dict:
+        """Returns the initial state of a newly uploaded chunk."""
+        return {
             "file_path": chunk_file_path,
             "file_name": chunk_name,
             "chunk_type": chunk_type,
@@ -35,8 +167,38 @@ class Conversation:
             "whisper_converted": False, # For Whisper processing
             "whisper_output": None      # To store the API output
         }
+
+    @classmethod
+    def from_stored(cls, conversation_id: str, state: dict):
+        """Rebuilds a conversation, including its counters, from RedisConversationStore.load() output."""
+        conversation = cls(conversation_id)
+        conversation.chunks = state["chunks"]
+        conversation.final_chunk_received = state["final_chunk_received"]
+        conversation.category_results = state["category_results"]
+        conversation._categorized_count = state.get("categorized_count")
+        for chunk in conversation.chunks.values():
+            conversation.pending_wav += not chunk["chunk_converted"]
+            conversation.pending_whisper += not chunk.get("whisper_converted", False)
+            conversation.converted_count += chunk["chunk_converted"] is True
+            conversation.whisper_count += chunk.get("whisper_converted") is True
+        return conversation
+
+    def add_chunk(self, chunk_number: int, chunk_file_path: str, chunk_name: str, chunk_type: str) -> bool:
+        """
+        Adds a chunk to the conversation.
+
+        Returns:
+            bool: False if a chunk with this number already exists (the existing entry is kept), otherwise True.
+        """
+        with self._counter_lock:
+            if chunk_number in self.chunks:
+                return False
+            self.chunks[chunk_number] = self.new_chunk(chunk_file_path, chunk_name, chunk_type)
+            self.pending_wav += 1
+            self.pending_whisper += 1
         if chunk_type.lower() == "final":
             self.final_chunk_received = True
+        return True
 
     def is_complete(self) -> bool:
         """
@@ -66,59 +228,68 @@ class Conversation:
 
     def has_pending_conversion(self) -> bool:
         """Returns True if there's at least one chunk not yet converted."""
-        for chunk in self.chunks.values():
-            if not chunk["chunk_converted"]:
-                return True
-        return False
+        return self.pending_wav > 0
 
     def has_pending_whisper(self) -> bool:
         """Returns True if there's at least one chunk not yet processed by Whisper."""
-        for chunk in self.chunks.values():
-            if not chunk.get("whisper_converted", False):
-                return True
-        return False
+        return self.pending_whisper > 0
+
+    def has_pending_category(self) -> bool:
+        """Returns True if Whisper has processed chunks since the last categorization."""
+        return len(self.chunks) - self.pending_whisper != self._categorized_count
 
-    def convert_next_chunk(self):
+    def convert_chunk(self, chunk_number: int):
         """
-        Finds and converts the next unconverted chunk using AudioConverter.
+        Converts the given chunk to WAV using AudioConverter.
+        On success the WAV path is stored in the chunk's 'wav_file_path' field.
         Returns a descriptive string indicating the result.
         """
-        for chunk_number in sorted(self.chunks.keys()):
-            chunk = self.chunks[chunk_number]
-            if not chunk["chunk_converted"]:
-                try:
-                    converter = AudioConverter(input_file=chunk["file_path"], output_folder="converted_wav")
-                    converted_path = converter()  # __call__ returns the converted file path.
-                    chunk["chunk_converted"] = True
-                    logging.info(f"Converted chunk {chunk_number} to WAV at {converted_path}")
-                    return f"Converted chunk {chunk_number}"
-                except Exception as e:
-                    logging.error(f"Failed to convert chunk {chunk_number}: {e}")
-                    chunk["chunk_converted"] = "Failed"
-                    return f"Conversion failed for chunk {chunk_number}"
-        return "No pending conversion"
+        chunk = self.chunks[chunk_number]
+        if chunk["chunk_converted"]:
+            return f"Chunk {chunk_number} already converted"
+        try:
+            converted_path = _convert_to_wav(chunk["file_path"])
+            chunk["chunk_converted"] = True
+            if os.path.exists(converted_path):
+                chunk["wav_file_path"] = converted_path
+            logging.debug("Converted chunk %s to WAV at %s", chunk_number, converted_path)
+            return f"Converted chunk {chunk_number}"
+        except Exception as e:
+            logging.error("Failed to convert chunk %s: %s", chunk_number, e)
+            chunk["chunk_converted"] = "Failed"
+            return f"Conversion failed for chunk {chunk_number}"
+        finally:
+            with self._counter_lock:
+                self.pending_wav -= 1
+                if chunk["chunk_converted"] is True:
+                    self.converted_count += 1
 
 
-    def convert_next_chunk_whisper(self):
+    def convert_chunk_whisper(self, chunk_number: int):
         """
-        Finds and processes the next unprocessed chunk using the whisper() API function.
+        Processes the given chunk using the whisper() API function, preferring the converted WAV
+        and falling back to the uploaded file if WAV conversion did not produce one.
         The output from the API is stored in the chunk's 'whisper_output' field.
         Returns a descriptive string indicating the result.
         """
-        for chunk_number in sorted(self.chunks.keys()):
-            chunk = self.chunks[chunk_number]
-            if not chunk.get("whisper_converted", False):
-                try:
-                    output = whisper(chunk["file_path"])  # Call your API function on the file.
-                    chunk["whisper_output"] = output
-                    chunk["whisper_converted"] = True
-                    logging.info(f"Whisper processed chunk {chunk_number} with output: {output}")
-                    return f"Whisper processed chunk {chunk_number}"
-                except Exception as e:
-                    logging.error(f"Whisper conversion failed for chunk {chunk_number}: {e}")
-                    chunk["whisper_converted"] = "Failed"
-                    return f"Whisper conversion failed for chunk {chunk_number}"
-        return "No pending Whisper conversion"
+        chunk = self.chunks[chunk_number]
+        if chunk.get("whisper_converted", False):
+            return f"Chunk {chunk_number} already processed by Whisper"
+        try:
+            output = _whisper(chunk.get("wav_file_path") or chunk["file_path"])  # Call your API function on the file.
+            chunk["whisper_output"] = output
+            chunk["whisper_converted"] = True
+            logging.debug("Whisper processed chunk %s with output: %s", chunk_number, output)
+            return f"Whisper processed chunk {chunk_number}"
+        except Exception as e:
+            logging.error("Whisper conversion failed for chunk %s: %s", chunk_number, e)
+            chunk["whisper_converted"] = "Failed"
+            return f"Whisper conversion failed for chunk {chunk_number}"
+        finally:
+            with self._counter_lock:
+                self.pending_whisper -= 1
+                if chunk["whisper_converted"] is True:
+                    self.whisper_count += 1
 
     
     def categorize(self, max_segment_words=20, overlap=10):
@@ -126,55 +297,54 @@ class Conversation:
         Collects words from all whisper outputs, creates overlapping segments, 
         calls the llama API on each segment, and stores the prompt and result.
         
-        - The first segment is the first max_segment_words.
-        - Subsequent segments are created with an overlap (last 'overlap' words from previous segment plus next words).
+        - Segments are max_segment_words long and start every (max_segment_words - overlap) words,
+          so each segment repeats the last 'overlap' words of the previous one.
+        - Trailing words that do not fill a whole segment are not sent.
         
         Returns:
             list: List of dictionaries with keys 'prompt' and 'result'.
             Returns None if insufficient words are available.
+
+        Raises:
+            ValueError: If overlap is not smaller than max_segment_words.
         """
+        if overlap >= max_segment_words:
+            raise ValueError(f"overlap ({overlap}) must be smaller than max_segment_words ({max_segment_words})")
+        # Marked as categorized only once this output needs no further llama calls, so failed runs are retried.
+        whisper_count = len(self.chunks) - self.pending_whisper
         # Concatenate whisper outputs in order.
-        all_text = ""
-        for chunk_number in sorted(self.chunks.keys()):
-            chunk = self.chunks[chunk_number]
-            if chunk.get("whisper_converted") is True and chunk.get("whisper_output"):
-                all_text += " " + chunk["whisper_output"]
-        all_text = all_text.strip()
+        chunks = self.chunks
+        parts = [
+            chunks[chunk_number]["whisper_output"]
+            for chunk_number in sorted(chunks)
+            if chunks[chunk_number].get("whisper_converted") is True and chunks[chunk_number].get("whisper_output")
+        ]
+        all_text = " ".join(parts).strip()
         if not all_text:
             logging.info("No whisper output available for categorization.")
+            self._categorized_count = whisper_count
             return None
         words = all_text.split()
         if len(words) < max_segment_words:
             logging.info("Not enough words to categorize. Need at least %d, got %d", max_segment_words, len(words))
+            self._categorized_count = whisper_count
             return None
 
-        segments = []
-        # First segment: first max_segment_words.
-        segments.append({"prompt": " ".join(words[:max_segment_words]), "result": None})
-        last_index = max_segment_words
-
-        # Create sliding windows.
-        while last_index < len(words):
-            start_index = max(last_index - overlap, 0)
-            end_index = start_index + max_segment_words
-            if end_index > len(words):
-                break
-            segments.append({"prompt": " ".join(words[start_index:end_index]), "result": None})
-            last_index = end_index
-
-        results = []
-        for seg in segments:
-            try:
-                logging.info("Sending categorization prompt: %s", seg["prompt"])
-                response = llama(seg["prompt"])
-                seg["result"] = response
-                results.append(seg)
-            except Exception as e:
-                logging.error("Error categorizing prompt '%s': %s", seg["prompt"], e)
-                seg["result"] = "Error"
-                results.append(seg)
-        self.category_results = results
-        return results
+        # Create sliding windows: segment i starts at i * stride, and only full segments are kept.
+        stride = max_segment_words - overlap
+        starts = range(0, len(words) - max_segment_words + 1, stride)
+        segments = [{"prompt": " ".join(words[start:start + max_segment_words]), "result": None} for start in starts]
+
+        # The llama calls are network-bound, so send the segments concurrently.
+        prompts = [seg["prompt"] for seg in segments]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=min(LLAMA_PARALLEL_LIMIT, len(prompts))) as executor:
+            responses = list(executor.map(_safe_llama, prompts))
+        for seg, response in zip(segments, responses):
+            seg["result"] = response
+        self.category_results = segments
+        if all(response is not None and response != "Error" for response in responses):
+            self._categorized_count = whisper_count
+        return segments
 
     def get_category_details(self):
             """Returns the list of categorization details (prompt and result) if available."""
@@ -186,58 +356,98 @@ class ConversationController:
     Controller class to manage multiple conversations.
     
     Attributes:
-        conversations (dict): A mapping from session_id to Conversation objects.
+        conversations (dict): A mapping from session_id to the Conversation objects handled by this process.
+        received_chunks (dict): A mapping from session_id to SessionState upload bookkeeping.
+
+    Args:
+        store (RedisConversationStore, optional): Shared store that chunk state is written through to,
+            so that conversations handled by other processes can be read and duplicates are detected across them.
     """
-    def __init__(self):
+    def __init__(self, store=None):
         logging.info("Started Conversion Controller.")
         self.conversations = {}  # {session_id: Conversation}
-        self._conversion_thread = None
-        self._whisper_thread = None
+        self._store = store
+        self.received_chunks = {}  # {session_id: SessionState}
+        # Guards self.conversations; readers iterate over snapshots taken under the lock.
+        self._conv_lock = threading.Lock()
         self._category_thread = None
         self._stop_event = threading.Event()
+        # Work queues fed by handle_chunk; items are (conversation, chunk_number), None stops a worker.
+        self._wav_queue = queue.Queue()
+        self._whisper_queue = queue.Queue()
+        # Long-lived daemon threads running the queue workers; see _start_workers.
+        self._workers = {"wav": [], "whisper": []}
+
+    def _start_workers(self, name, worker, parallel_limit):
+        """
+        Starts parallel_limit daemon threads running worker for the given name ("wav" or "whisper").
+        The threads are only (re)started when none are running yet or parallel_limit changed.
+        Plain daemon threads are used rather than a ThreadPoolExecutor, whose exit hook would wait
+        forever on workers blocked on an empty queue.
+        """
+        threads = self._workers[name]
+        if threads and len(threads) == parallel_limit:
+            return
+        if threads:
+            self._stop_workers(name)
+        threads = [
+            threading.Thread(target=worker, name=f"{name}_{i}", daemon=True)
+            for i in range(parallel_limit)
+        ]
+        for thread in threads:
+            thread.start()
+        self._workers[name] = threads
+
+    def _stop_workers(self, name):
+        """Sends a stop sentinel to every worker of the given name and waits for in-flight tasks to finish."""
+        threads = self._workers[name]
+        work_queue = getattr(self, f"_{name}_queue")
+        for _ in threads:
+            work_queue.put(None)
+        for thread in threads:
+            thread.join()
+        self._workers[name] = []
+
+    def _run_worker(self, work_queue, task, next_queue=None):
+        """
+        Blocks on work_queue and runs task(conversation, chunk_number) for every item until a
+        None sentinel arrives. Processed items are forwarded to next_queue.
+        Only the sentinel stops a worker, so every worker consumes exactly one sentinel from _stop_workers
+        and items queued before it are still processed.
+        """
+        while True:
+            item = work_queue.get()
+            try:
+                if item is None:
+                    return
+                conversation, chunk_number = item
+                result = task(conversation, chunk_number)
+                logging.debug("Conversion task result: %s", result)
+                if self._store is not None:
+                    self._store.save_chunk(conversation.conversation_id, chunk_number, conversation.chunks[chunk_number])
+                if next_queue is not None:
+                    next_queue.put(item)
+            except Exception as e:
+                logging.error("Conversion task raised an exception: %s", e)
+            finally:
+                work_queue.task_done()
     
     ## AUDIO CONVERTER:
 
-    def convert_chunks_to_wav(self, parallel_limit=10):
-        with concurrent.futures.ThreadPoolExecutor(max_workers=parallel_limit) as executor:
-            futures = []
-            for conversation in self.conversations.values():
-                if conversation.has_pending_conversion():
-                    future = executor.submit(conversation.convert_next_chunk)
-                    futures.append(future)
-            for future in concurrent.futures.as_completed(futures):
-                try:
-                    result = future.result()
-                    # Only log as INFO if a conversion occurred or failed; otherwise, log at DEBUG.
-                    if result not in ("No pending conversion",):
-                        logging.info(f"Conversion task result: {result}")
-                    else:
-                        logging.debug(f"Conversion task result: {result}")
-                except Exception as e:
-                    logging.error(f"Conversion task raised an exception: {e}")
-
-    def _background_conversion_loop(self, check_interval, parallel_limit):
-        while not self._stop_event.is_set():
-            self.convert_chunks_to_wav(parallel_limit=parallel_limit)
-            time.sleep(check_interval)
+    def _wav_worker(self):
+        # Whisper works on the converted WAV, so every converted chunk is chained to the Whisper queue.
+        self._run_worker(self._wav_queue, Conversation.convert_chunk, next_queue=self._whisper_queue)
 
-    def start_background_conversion(self, check_interval=5, parallel_limit=10):
+    def start_background_conversion(self, parallel_limit=10):
         """
-        Starts a background thread that periodically checks and converts unconverted chunks.
+        Starts background workers that convert chunks to WAV as soon as handle_chunk queues them.
         
         Args:
-            check_interval (int): Number of seconds to wait between checks.
             parallel_limit (int): Maximum number of concurrent conversion tasks.
         """
-        if self._conversion_thread is None or not self._conversion_thread.is_alive():
-            self._stop_event.clear()
-            self._conversion_thread = threading.Thread(
-                target=self._background_conversion_loop,
-                args=(check_interval, parallel_limit),
-                daemon=True
-            )
-            self._conversion_thread.start()
-            logging.info("Started background conversion thread.")
+        self._stop_event.clear()
+        self._start_workers("wav", self._wav_worker, parallel_limit)
+        logging.info("Started background conversion workers.")
 
     # def stop_background_conversion(self):
     #     """Stops the background conversion thread gracefully."""
@@ -248,73 +458,73 @@ class ConversationController:
 
     ## WHISPER:
 
-    def convert_chunks_to_whisper(self, parallel_limit=10):
-        with concurrent.futures.ThreadPoolExecutor(max_workers=parallel_limit) as executor:
-            futures = []
-            for conversation in self.conversations.values():
-                if conversation.has_pending_whisper():
-                    future = executor.submit(conversation.convert_next_chunk_whisper)
-                    futures.append(future)
-            for future in concurrent.futures.as_completed(futures):
-                try:
-                    result = future.result()
-                    # Only log as INFO if a conversion occurred or failed; otherwise, log at DEBUG.
-                    if result not in ("No pending conversion",):
-                        logging.info(f"Conversion task result: {result}")
-                    else:
-                        logging.debug(f"Conversion task result: {result}")
-                except Exception as e:
-                    logging.error(f"Conversion task raised an exception: {e}")
+    def _whisper_worker(self):
+        self._run_worker(self._whisper_queue, Conversation.convert_chunk_whisper)
 
-    def start_background_whisper_conversion(self, check_interval=5, parallel_limit=10):
+    def start_background_whisper_conversion(self, parallel_limit=10):
         """
-        Starts a background thread that periodically checks and processes unconverted chunks with Whisper.
+        Starts background workers that process chunks with Whisper once their WAV conversion has finished.
         """
-        # We create a separate thread for Whisper conversion.
-        self._whisper_thread = threading.Thread(
-            target=self._background_whisper_conversion_loop,
-            args=(check_interval, parallel_limit),
-            daemon=True
-        )
-        self._whisper_thread.start()
-        logging.info("Started background Whisper conversion thread.")
-
-    def stop_background_conversions(self):
-        """Stops the background conversion threads gracefully."""
-        self._stop_event.set()
-        if self._conversion_thread is not None:
-            self._conversion_thread.join()
-            logging.info("Stopped background WAV conversion thread.")
-        if hasattr(self, '_whisper_thread') and self._whisper_thread is not None:
-            self._whisper_thread.join()
-            logging.info("Stopped background Whisper conversion thread.")
-
-
-    def _background_whisper_conversion_loop(self, check_interval, parallel_limit):
-        while not self._stop_event.is_set():
-            self.convert_chunks_to_whisper(parallel_limit=parallel_limit)
-            time.sleep(check_interval)
-
+        self._stop_event.clear()
+        self._start_workers("whisper", self._whisper_worker, parallel_limit)
+        logging.info("Started background Whisper conversion workers.")
 
         # Category conversion methods:
+    def _categorize(self, conversation):
+        """
+        Categorizes a conversation. With a store, the conversation is the merged stored state of the session,
+        and only the process that claims the session categorizes it and writes the results back.
+        A session that still needs categorizing afterwards (claimed elsewhere, or a llama call failed)
+        is marked dirty again so it is retried on the next tick.
+        """
+        if self._store is None:
+            return conversation.categorize()
+        session_id = conversation.conversation_id
+        token = self._store.claim_categorization(session_id, CATEGORY_CLAIM_TIMEOUT)
+        if token is None:
+            self._store.mark_dirty(session_id)
+            return None
+        try:
+            result = conversation.categorize()
+            # Also records the count when there was too little text, so the session is not loaded again.
+            self._store.save_category_results(session_id, result, conversation._categorized_count)
+            return result
+        finally:
+            self._store.release_categorization(session_id, token)
+            if conversation.has_pending_category():
+                self._store.mark_dirty(session_id)
+
     def convert_chunks_to_category(self, parallel_limit=5):
+        if self._store is not None:
+            # Only sessions with new Whisper output, categorized from their merged state rather than
+            # the chunks this process received.
+            states = self._store.load_many(self._store.take_dirty())
+            conversations = [
+                Conversation.from_stored(session_id, state) for session_id, state in states.items() if state is not None
+            ]
+        else:
+            with self._conv_lock:
+                conversations = list(self.conversations.values())
         with concurrent.futures.ThreadPoolExecutor(max_workers=parallel_limit) as executor:
             futures = []
-            for conversation in self.conversations.values():
+            for conversation in conversations:
                 # Only attempt categorization if there is new whisper output.
-                futures.append(executor.submit(conversation.categorize))
+                if conversation.has_pending_category():
+                    futures.append(executor.submit(self._categorize, conversation))
             for future in concurrent.futures.as_completed(futures):
                 try:
                     result = future.result()
                     if result:
-                        logging.info("Category conversion task result: %s", result)
+                        logging.debug("Category conversion task result: %s", result)
                 except Exception as e:
                     logging.error("Category conversion task raised an exception: %s", e)
 
     def _background_category_loop(self, check_interval, parallel_limit):
         while not self._stop_event.is_set():
             self.convert_chunks_to_category(parallel_limit=parallel_limit)
-            time.sleep(check_interval)
+            # Returns as soon as stop_background_conversions() sets the event.
+            if self._stop_event.wait(check_interval):
+                break
 
     def start_background_category_conversion(self, check_interval=10, parallel_limit=5):
         if self._category_thread is None or not self._category_thread.is_alive():
@@ -328,13 +538,13 @@ class ConversationController:
             logging.info("Started background category conversion thread.")
 
     def stop_background_conversions(self):
+        """Stops the background conversion workers and the category thread gracefully."""
         self._stop_event.set()
-        if self._conversion_thread is not None:
-            self._conversion_thread.join()
-            logging.info("Stopped background WAV conversion thread.")
-        if self._whisper_thread is not None:
-            self._whisper_thread.join()
-            logging.info("Stopped background Whisper conversion thread.")
+        self._stop_workers("wav")
+        _shutdown_wav_process_pool()
+        logging.info("Stopped background WAV conversion workers.")
+        self._stop_workers("whisper")
+        logging.info("Stopped background Whisper conversion workers.")
         if self._category_thread is not None:
             self._category_thread.join()
             logging.info("Stopped background category conversion thread.")
@@ -345,6 +555,7 @@ class ConversationController:
         """
         Handles an incoming chunk: if a conversation with the given session_id exists, it adds the chunk to it;
         otherwise, it creates a new conversation and then adds the chunk.
+        A chunk number that the conversation already has is rejected and its file removed.
         
         Args:
             session_id (str): The session identifier.
@@ -356,21 +567,48 @@ class ConversationController:
         Returns:
             Conversation: The conversation with the chunk added.
         """
-        conversation = self.conversations.get(session_id)
-        if conversation is None:
-            conversation = Conversation(session_id)
-            self.conversations[session_id] = conversation
-
-        conversation.add_chunk(chunk_number, chunk_file_path, chunk_name, chunk_type)
+        with self._conv_lock:
+            conversation = self.conversations.get(session_id)
+            if conversation is None:
+                conversation = Conversation(session_id)
+                self.conversations[session_id] = conversation
+
+        # With a shared store, another process may already hold this chunk number; the store decides atomically.
+        is_duplicate = chunk_number in conversation.chunks or (
+            self._store is not None
+            and not self._store.add_chunk(session_id, chunk_number, Conversation.new_chunk(chunk_file_path, chunk_name, chunk_type))
+        )
+        if is_duplicate or not conversation.add_chunk(chunk_number, chunk_file_path, chunk_name, chunk_type):
+            logging.warning("Duplicate chunk %d for session %s; discarding %s", chunk_number, session_id, chunk_file_path)
+            try:
+                os.unlink(chunk_file_path)
+            except OSError as e:
+                logging.error("Could not remove duplicate chunk file %s: %s", chunk_file_path, e)
+            return conversation
+        # Hand the chunk straight to the WAV workers; they chain it on to Whisper.
+        self._wav_queue.put((conversation, chunk_number))
         
         # Optionally, if the conversation is complete, remove it from the controller.
         if conversation.is_complete():
-            logging.info(f"Conversation {session_id} is complete. Chunks: {conversation.chunks}")
+            logging.info("Conversation %s is complete. Chunks: %s", session_id, conversation.chunks)
             # Uncomment the following line to remove completed conversations:
             # del self.conversations[session_id]
         
         return conversation
     
+    @property
+    def has_store(self) -> bool:
+        """True if conversation state is shared with other processes through a store."""
+        return self._store is not None
+
+    def filter_stored_chunks(self, session_id: str, chunk_numbers):
+        """
+        Returns the chunk numbers from chunk_numbers that no process has stored, e.g. to check which chunks
+        missing from this process's SessionState were uploaded to another worker.
+        """
+        stored = self._store.chunk_numbers(session_id)
+        return [n for n in chunk_numbers if n not in stored]
+
     def get_conversation_data(self, session_id: str):
         """
         Returns the data for a given conversation if it exists.
@@ -381,7 +619,7 @@ class ConversationController:
         Returns:
             dict or None: A dictionary containing the conversation's details, or None if not found.
         """
-        conversation = self.conversations.get(session_id)
+        conversation = self._get_conversation(session_id)
         if conversation is None:
             return None
         return {
@@ -391,20 +629,46 @@ class ConversationController:
             "missing_chunks": conversation.get_missing_chunks()
         }
 
-    def get_whisper_outputs(self):
+    def _get_conversation(self, session_id: str):
+        """
+        Returns the conversation for session_id. With a store, this is a read-only copy of the stored state,
+        since chunks of one session may have been handled by several processes.
+        """
+        if self._store is not None:
+            state = self._store.load(session_id)
+            return Conversation.from_stored(session_id, state) if state is not None else None
+        with self._conv_lock:
+            return self.conversations.get(session_id)
+
+    def _get_all_conversations(self):
+        """Returns a snapshot list of (session_id, Conversation) pairs, read from the store if there is one."""
+        if self._store is None:
+            with self._conv_lock:
+                return list(self.conversations.items())
+        return [
+            (session_id, Conversation.from_stored(session_id, state))
+            for session_id, state in self._store.load_all().items()
+        ]
+
+    def get_whisper_outputs(self, conversations=None):
         """
         Returns a list of dictionaries for each chunk across all conversations,
         containing the conversation ID, chunk number, and the whisper output.
 
+        Args:
+            conversations (list, optional): (session_id, Conversation) pairs to use instead of a fresh snapshot.
+
         Returns:
             list: A list of dictionaries, each with keys:
                 'conversation_id', 'chunk_number', and 'whisper_output'.
         """
         whisper_dict = {}
+        if conversations is None:
+            conversations = self._get_all_conversations()
         try:
-            for conv_id, conversation in self.conversations.items():
+            for conv_id, conversation in conversations:
                 outputs = []
-                for chunk_number, chunk in conversation.chunks.items():
+                for chunk_number, chunk in list(conversation.chunks.items()):
                     outputs.append({
                         #"conversation_id": conv_id,
                         #"chunk_number": chunk_number,
@@ -439,20 +703,21 @@ class ConversationController:
     def get_all_conversation_summary(self):
         try:
             summary = []
-            for conv_id, conversation in self.conversations.items():
-                converted_count = sum(1 for chunk in conversation.chunks.values() if chunk["chunk_converted"] is True)
-                whisper_count = sum(1 for chunk in conversation.chunks.values() if chunk.get("whisper_converted") is True)
+            # Build the outputs for every conversation once rather than once per conversation.
+            conversations = self._get_all_conversations()
+            all_outputs = self.get_whisper_outputs(conversations)
+            for conv_id, conversation in conversations:
                 summary.append({
                     "conversation_id": conv_id,
                     "file_count": len(conversation.chunks),
-                    "converted_count": converted_count,
-                    "whisper_count": whisper_count,
-                    "whisper_outputs": self.get_whisper_outputs().get(conv_id),
+                    "converted_count": conversation.converted_count,
+                    "whisper_count": conversation.whisper_count,
+                    "whisper_outputs": all_outputs.get(conv_id),
                     "category_details": conversation.get_category_details()
                 })
             return summary
         except Exception as e:
-            logging.error(f"Error in get_all_conversation_summary: {e}")
+            logging.error("Error in get_all_conversation_summary: %s", e)
             return []
 
 
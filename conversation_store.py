@@ -0,0 +1,187 @@
+"""
+Redis persistence for conversations, so every API worker (and a restarted one) sees the same sessions.
+
+Layout per session id:
+    conv:{sid}:chunks  hash of chunk number -> chunk dict as JSON
+    conv:{sid}:meta    hash with 'final_chunk_received', 'category_results' (JSON) and 'categorized_count'
+    conv:{sid}:category_lock  token of the process currently categorizing the session (expires)
+    conversations      set of all session ids
+    conversations:dirty  set of session ids with Whisper output that has not been categorized yet
+
+The chunks and meta hashes expire SESSION_TTL seconds after a session's last write; ids of expired
+sessions are pruned from the 'conversations' set when it is read.
+"""
+import json
+import os
+import uuid
+import redis
+
+SESSION_TTL = int(os.getenv("SESSION_TTL", 7 * 24 * 60 * 60))
+
+# Adds a chunk only if its number is new, registering the session and the final flag in the same round trip.
+# KEYS: chunks hash, meta hash, session set. ARGV: chunk number, chunk JSON, "1" if final, session id, TTL.
+ADD_CHUNK_SCRIPT = """
+if redis.call('HSETNX', KEYS[1], ARGV[1], ARGV[2]) == 0 then
+    return 0
+end
+redis.call('SADD', KEYS[3], ARGV[4])
+if ARGV[3] == '1' then
+    redis.call('HSET', KEYS[2], 'final_chunk_received', '1')
+end
+redis.call('EXPIRE', KEYS[1], ARGV[5])
+redis.call('EXPIRE', KEYS[2], ARGV[5])
+return 1
+"""
+
+# Deletes a lock only if it still holds the caller's token, so an expired and re-taken lock is left alone.
+# KEYS: lock key. ARGV: token.
+RELEASE_LOCK_SCRIPT = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+CONVERSATIONS_KEY = "conversations"
+DIRTY_KEY = "conversations:dirty"
+
+
+class RedisConversationStore:
+    """
+    Write-through store for Conversation state.
+
+    Args:
+        url (str): Redis connection URL, e.g. "redis://localhost:6379/0".
+    """
+    def __init__(self, url: str):
+        self._redis = redis.Redis.from_url(url, decode_responses=True)
+        self._add_chunk = self._redis.register_script(ADD_CHUNK_SCRIPT)
+        self._release_lock = self._redis.register_script(RELEASE_LOCK_SCRIPT)
+
+    @staticmethod
+    def _chunks_key(session_id: str) -> str:
+        return f"conv:{session_id}:chunks"
+
+    @staticmethod
+    def _meta_key(session_id: str) -> str:
+        return f"conv:{session_id}:meta"
+
+    @staticmethod
+    def _category_lock_key(session_id: str) -> str:
+        return f"conv:{session_id}:category_lock"
+
+    def add_chunk(self, session_id: str, chunk_number: int, chunk: dict) -> bool:
+        """Atomically stores a new chunk. Returns False if any worker already stored this chunk number."""
+        is_final = "1" if chunk["chunk_type"].lower() == "final" else "0"
+        added = self._add_chunk(
+            keys=[self._chunks_key(session_id), self._meta_key(session_id), CONVERSATIONS_KEY],
+            args=[chunk_number, json.dumps(chunk), is_final, session_id, SESSION_TTL],
+        )
+        return bool(added)
+
+    def save_chunk(self, session_id: str, chunk_number: int, chunk: dict):
+        """
+        Overwrites the stored state of an existing chunk, e.g. after a conversion step.
+        A chunk with Whisper output marks its session for categorization.
+        """
+        pipe = self._redis.pipeline()
+        pipe.hset(self._chunks_key(session_id), chunk_number, json.dumps(chunk))
+        pipe.expire(self._chunks_key(session_id), SESSION_TTL)
+        if chunk.get("whisper_converted") is True:
+            pipe.sadd(DIRTY_KEY, session_id)
+        pipe.execute()
+
+    def save_category_results(self, session_id: str, category_results, categorized_count):
+        """
+        Stores the categorization of a session together with the Whisper-processed chunk count it was built from.
+        Either may be None to leave the stored value unchanged.
+        """
+        mapping = {}
+        if category_results is not None:
+            mapping["category_results"] = json.dumps(category_results)
+        if categorized_count is not None:
+            mapping["categorized_count"] = categorized_count
+        if not mapping:
+            return
+        pipe = self._redis.pipeline()
+        pipe.hset(self._meta_key(session_id), mapping=mapping)
+        pipe.expire(self._meta_key(session_id), SESSION_TTL)
+        pipe.execute()
+
+    def take_dirty(self):
+        """Returns the ids of the sessions marked for categorization and clears the marks, atomically."""
+        pipe = self._redis.pipeline(transaction=True)
+        pipe.smembers(DIRTY_KEY)
+        pipe.delete(DIRTY_KEY)
+        session_ids, _ = pipe.execute()
+        return session_ids
+
+    def mark_dirty(self, session_id: str):
+        """Marks a session for categorization again, e.g. after a failed or skipped attempt."""
+        self._redis.sadd(DIRTY_KEY, session_id)
+
+    def claim_categorization(self, session_id: str, timeout: int):
+        """
+        Claims the right to categorize a session, so only one process sends its transcript to Llama at a time.
+        The claim expires after timeout seconds in case its holder dies.
+
+        Returns:
+            str or None: A token to pass to release_categorization(), or None if another process holds the claim.
+        """
+        token = uuid.uuid4().hex
+        if self._redis.set(self._category_lock_key(session_id), token, nx=True, ex=timeout):
+            return token
+        return None
+
+    def release_categorization(self, session_id: str, token: str):
+        self._release_lock(keys=[self._category_lock_key(session_id)], args=[token])
+
+    def conversation_ids(self):
+        return self._redis.smembers(CONVERSATIONS_KEY)
+
+    def load_all(self):
+        """Returns {session_id: state} for every stored session, pruning the ids of expired sessions."""
+        states = self.load_many(self.conversation_ids())
+        expired = [session_id for session_id, state in states.items() if state is None]
+        if expired:
+            self._redis.srem(CONVERSATIONS_KEY, *expired)
+        return {session_id: state for session_id, state in states.items() if state is not None}
+
+    def chunk_numbers(self, session_id: str):
+        """Returns the set of chunk numbers stored for a session by any process."""
+        return {int(number) for number in self._redis.hkeys(self._chunks_key(session_id))}
+
+    @staticmethod
+    def _parse(chunks: dict, meta: dict):
+        if not chunks:
+            return None
+        categorized_count = meta.get("categorized_count")
+        return {
+            "chunks": {int(number): json.loads(chunk) for number, chunk in chunks.items()},
+            "final_chunk_received": meta.get("final_chunk_received") == "1",
+            "category_results": json.loads(meta.get("category_results", "[]")),
+            "categorized_count": int(categorized_count) if categorized_count is not None else None,
+        }
+
+    def load(self, session_id: str):
+        """
+        Returns the stored state of a conversation, or None if it is unknown.
+
+        Returns:
+            dict or None: {"chunks": {int: dict}, "final_chunk_received": bool, "category_results": list,
+                "categorized_count": int or None}
+        """
+        return self.load_many([session_id])[session_id]
+
+    def load_many(self, session_ids):
+        """Returns {session_id: load(session_id)} for all session_ids in a single round trip."""
+        session_ids = list(session_ids)
+        pipe = self._redis.pipeline()
+        for session_id in session_ids:
+            pipe.hgetall(self._chunks_key(session_id))
+            pipe.hgetall(self._meta_key(session_id))
+        results = pipe.execute()
+        return {
+            session_id: self._parse(results[2 * i], results[2 * i + 1])
+            for i, session_id in enumerate(session_ids)
+        }
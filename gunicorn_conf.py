@@ -0,0 +1,20 @@
+"""
+Production server configuration:
+    gunicorn -c gunicorn_conf.py backend:app
+
+Each worker imports backend.py and so gets its own ConversationController, background workers and
+in-memory conversations. A session's chunks are converted by the worker that received them.
+
+Set REDIS_URL to run several workers: chunk state is then written through to Redis, so status requests,
+duplicate detection, final-chunk checks and categorization see the chunks of every worker. Without it each
+worker only sees its own sessions, so the default is a single worker (or route each session to one worker
+with sticky sessions and set WEB_CONCURRENCY yourself).
+"""
+import os
+
+bind = os.getenv("BIND", "0.0.0.0:8888")
+workers = int(os.getenv("WEB_CONCURRENCY", (os.cpu_count() or 1) * 2 + 1 if os.getenv("REDIS_URL") else 1))
+worker_class = "uvicorn.workers.UvicornWorker"
+keepalive = 5
+# Let the lifespan handler stop the background workers before a worker is killed.
+graceful_timeout = 30
@@ -1,62 +1,222 @@
 import os
+import asyncio
+import httpx
 import requests
-import base64
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import diskcache
+import functools
+import hashlib
 import logging
+import orjson
+import random
 import time
 from dotenv import load_dotenv
+from utils.convert_all_formats_to_wav import AudioConverter
+from utils.throttle import API_THROTTLE
+
+try:
+    # SIMD base64, several times faster than the standard library on MB-sized audio.
+    from pybase64 import b64encode
+except ImportError:
+    from base64 import b64encode
+
+logger = logging.getLogger(__name__)
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Set up logging configuration
-logging.basicConfig(level=logging.INFO)
-
 # Configuration constants
 USER_ID = os.getenv("USER_ID")
-API_BASE_URL = f"https://api.cloudflare.com/client/v4/accounts/{USER_ID}/ai/run/"
 API_TOKEN = os.getenv("API_TOKEN")
-if not API_TOKEN:
-    logging.error("API_TOKEN not found in environment variables!")
+# Without these every call fails with a 4xx that no retry can fix, so refuse to start instead.
+if not USER_ID or not API_TOKEN:
+    raise EnvironmentError("USER_ID and API_TOKEN must be set in the environment or the .env file.")
+API_BASE_URL = f"https://api.cloudflare.com/client/v4/accounts/{USER_ID}/ai/run/"
 HEADERS = {"Authorization": f"Bearer {API_TOKEN}"}
+LLAMA_URL = f"{API_BASE_URL}@cf/meta/llama-3-8b-instruct"
+WHISPER_URL = f"{API_BASE_URL}@cf/openai/whisper-large-v3-turbo"
+# "cloudflare" sends audio to WHISPER_URL; "local" transcribes it in this process with faster-whisper.
+WHISPER_BACKEND = os.getenv("WHISPER_BACKEND", "cloudflare")
+if WHISPER_BACKEND == "local":
+    from utils import local_whisper
+else:
+    local_whisper = None
+# (connect, read) timeouts in seconds for API calls.
+REQUEST_TIMEOUT = (3.05, 60)
+# Upper bound in seconds for the backoff between retries.
+RETRY_MAX_DELAY = 30
+
+# Shared session so calls reuse pooled keep-alive connections instead of a new TCP+TLS handshake each time.
+# Retries are handled by the callers, so the adapter itself never retries.
+SESSION = requests.Session()
+SESSION.headers.update(HEADERS)
+SESSION.mount("https://", HTTPAdapter(pool_connections=8, pool_maxsize=32, max_retries=Retry(total=0)))
+
+CATEGORIES = ["music", "science"]
+LLAMA_SYSTEM_PROMPT = f"You are a friendly assistant that helps categorise conversations and summarises if there is any of these categories in the text: {str(CATEGORIES)}"
+
+# On-disk cache of Llama responses, shared by all processes on the host.
+LLAMA_CACHE_DIR = os.getenv("LLAMA_CACHE_DIR", "./.llm_cache")
+LLAMA_CACHE_TTL = 14 * 24 * 60 * 60
+LLAMA_CACHE_SIZE = 200 * 1024 * 1024
+# On-disk cache of Whisper transcriptions keyed on the audio contents.
+WHISPER_CACHE_DIR = os.getenv("WHISPER_CACHE_DIR", "./.whisper_cache")
+WHISPER_CACHE_TTL = 30 * 24 * 60 * 60
+# Bytes of audio read per base64 block; a multiple of 3, large enough that per-call overhead is negligible.
+BASE64_BLOCK_SIZE = 3 * 256 * 1024
+RAW_AUDIO_HEADERS = {"Content-Type": "application/octet-stream"}
+# Whether the Whisper endpoint accepts the WAV as a raw request body; None until the first upload tells.
+_raw_upload_supported = None
 
 
 
 
 
+def _retry_delay(error, attempt, base_delay):
+    """
+    Returns the number of seconds to wait before retrying after error, or None if retrying cannot help.
+
+    Network errors, HTTP 429 and 5xx responses are retried with jittered exponential backoff capped at
+    RETRY_MAX_DELAY; a 429 with a numeric Retry-After header waits that long instead. Other 4xx responses
+    and non-HTTP errors (e.g. an unexpected response body) are not retried.
+    """
+    response = getattr(error, "response", None)
+    status = getattr(response, "status_code", None)
+    if status is None:
+        if not isinstance(error, (requests.exceptions.RequestException, httpx.TransportError)):
+            return None
+    elif status == 429:
+        try:
+            return float(response.headers.get("Retry-After"))
+        except (TypeError, ValueError):
+            pass
+    elif status < 500:
+        return None
+    return min(RETRY_MAX_DELAY, base_delay * 2 ** attempt) * (1 + random.random() * 0.5)
+
+def retry(name):
+    """
+    Decorator retrying a single-attempt API call (sync or async) that raises on failure.
+
+    The wrapped function accepts two extra keyword arguments:
+        max_retries (int): Maximum number of attempts (default 3).
+        retry_delay (float): Base delay in seconds for the exponential backoff (default 2).
+    It returns None once the attempts are exhausted or the error is not retryable.
+    """
+    def on_error(error, attempt, max_retries, retry_delay):
+        logger.error("Error in %s API call on attempt %d: %s", name, attempt+1, error)
+        if attempt >= max_retries - 1:
+            return None
+        return _retry_delay(error, attempt, retry_delay)
+
+    def decorator(func):
+        if asyncio.iscoroutinefunction(func):
+            @functools.wraps(func)
+            async def async_wrapper(*args, max_retries=3, retry_delay=2, **kwargs):
+                for attempt in range(max_retries):
+                    try:
+                        return await func(*args, **kwargs)
+                    except Exception as e:
+                        delay = on_error(e, attempt, max_retries, retry_delay)
+                        if delay is None:
+                            return None
+                        await asyncio.sleep(delay)
+                return None
+            return async_wrapper
+
+        @functools.wraps(func)
+        def wrapper(*args, max_retries=3, retry_delay=2, **kwargs):
+            for attempt in range(max_retries):
+                try:
+                    return func(*args, **kwargs)
+                except Exception as e:
+                    delay = on_error(e, attempt, max_retries, retry_delay)
+                    if delay is None:
+                        return None
+                    time.sleep(delay)
+            return None
+        return wrapper
+    return decorator
+
+JSON_HEADERS = {"Content-Type": "application/json"}
+
+def _post(url, json=None, **kwargs):
+    """
+    SESSION.post gated by the shared adaptive throttle, which also learns from the response code.
+    A json body is serialised with orjson, which is several times faster than the standard library on
+    payloads carrying megabytes of base64 audio.
+    """
+    if json is not None:
+        kwargs.update(data=orjson.dumps(json), headers=JSON_HEADERS)
+    API_THROTTLE.acquire()
+    response = SESSION.post(url, timeout=REQUEST_TIMEOUT, **kwargs)
+    API_THROTTLE.observe(response.status_code)
+    return response
+
+async def _post_async(client, url, json=None, **kwargs):
+    """Async counterpart of _post() for an httpx.AsyncClient."""
+    if json is not None:
+        kwargs.update(content=orjson.dumps(json), headers=JSON_HEADERS)
+    await API_THROTTLE.acquire_async()
+    response = await client.post(url, **kwargs)
+    API_THROTTLE.observe(response.status_code)
+    return response
+
+def _llama_payload(prompt):
+    """Builds the Llama request body for a user prompt."""
+    return {
+        "messages": [
+            {"role": "system", "content": LLAMA_SYSTEM_PROMPT},
+            {"role": "user", "content": prompt}
+        ]
+    }
+
+def _llama_result(response):
+    """Checks a Llama HTTP response (requests or httpx) and returns the response text."""
+    logger.debug("Llama response code %d", response.status_code)
+    response.raise_for_status()
+    result = orjson.loads(response.content)
+    logger.debug("Llama response: %s", result)
+    return result.get("result").get("response")
+
+@functools.cache
+def _llama_cache():
+    """Opens the Llama response cache on first use so importing this module does not touch the disk."""
+    return diskcache.Cache(LLAMA_CACHE_DIR, size_limit=LLAMA_CACHE_SIZE)
+
+def _llama_cache_key(prompt):
+    """Identifies a response by model, system prompt and user prompt."""
+    return hashlib.sha256("\0".join((LLAMA_URL, LLAMA_SYSTEM_PROMPT, prompt)).encode()).hexdigest()
+
+def _cache_llama_result(key, result):
+    # Failures are not cached so the prompt is retried on the next call.
+    if result is not None:
+        _llama_cache().set(key, result, expire=LLAMA_CACHE_TTL)
+    return result
+
+@retry("llama")
+def _post_llama(prompt):
+    return _llama_result(_post(LLAMA_URL, json=_llama_payload(prompt)))
+
 def llama(prompt, max_retries=3, retry_delay=2):
     """
     Sends a prompt to the Llama language model endpoint and returns the response.
+    Responses are cached on disk, so repeating a prompt does not call the API again.
     
     Args:
         prompt (str): The user prompt to send.
         max_retries (int): Maximum number of attempts.
-        retry_delay (int): Seconds to wait between attempts.
+        retry_delay (int): Base delay in seconds for the backoff between attempts.
     
     Returns:
-        dict or None: The JSON response from the Llama API or None if all attempts fail.
+        str or None: The response text from the Llama API or None if all attempts fail.
     """
-    categories = ["music", "science"]
-    payload = {
-        "messages": [
-            {"role": "system", "content": f"You are a friendly assistant that helps categorise conversations and summarises if there is any of these categories in the text: {str(categories)}"},
-            {"role": "user", "content": prompt}
-        ]
-    }
-    model_endpoint = "@cf/meta/llama-3-8b-instruct"
-    url = f"{API_BASE_URL}{model_endpoint}"
-    for attempt in range(max_retries):
-        try:
-            response = requests.post(url, headers=HEADERS, json=payload)
-            logging.info("Llama attempt %d: response code %d", attempt+1, response.status_code)
-            response.raise_for_status()
-            result = response.json()
-            logging.info("Llama response: %s", result)
-            return result.get("result").get("response")
-        except Exception as e:
-            logging.error("Error in llama API call on attempt %d: %s", attempt+1, e)
-            if attempt < max_retries - 1:
-                time.sleep(retry_delay)
-    return None
+    key = _llama_cache_key(prompt)
+    cached = _llama_cache().get(key)
+    if cached is not None:
+        return cached
+    return _cache_llama_result(key, _post_llama(prompt, max_retries=max_retries, retry_delay=retry_delay))
 
 def base64encodewavfile(file_path):
     """
@@ -69,11 +229,15 @@ def base64encodewavfile(file_path):
         str or None: Base64 encoded string of the file contents, or None if an error occurs.
     """
     try:
+        # Encode in blocks whose size is a multiple of 3 so no padding appears mid-stream,
+        # keeping only one block of raw audio in memory next to the output buffer.
+        encoded = bytearray()
         with open(file_path, "rb") as f:
-            encoded = base64.b64encode(f.read()).decode("utf-8")
-        return encoded
+            for block in iter(lambda: f.read(BASE64_BLOCK_SIZE), b""):
+                encoded += b64encode(block)
+        return encoded.decode("ascii")
     except Exception as e:
-        logging.error("Error encoding WAV file '%s': %s", file_path, e)
+        logger.error("Error encoding WAV file '%s': %s", file_path, e)
         return None
 
 def extract_final_text(response):
@@ -93,53 +257,264 @@ def extract_final_text(response):
             if text is not None:
                 return text.strip()
             else:
-                logging.error("No 'text' key found in result: %s", result)
+                logger.error("No 'text' key found in result: %s", result)
                 return None
         else:
-            logging.error("Response unsuccessful: %s", response)
+            logger.error("Response unsuccessful: %s", response)
             return None
     except Exception as e:
-        logging.error("Error extracting final text: %s", e)
+        logger.error("Error extracting final text: %s", e)
         return None
 
+def _whisper_result(response):
+    """Checks a Whisper HTTP response (requests or httpx) and returns the transcription text."""
+    logger.debug("Whisper response code %d", response.status_code)
+    response.raise_for_status()
+    result = orjson.loads(response.content)
+    logger.debug("Whisper response: %s", result)
+    return extract_final_text(result)
+
+@functools.cache
+def _whisper_cache():
+    return diskcache.Cache(WHISPER_CACHE_DIR)
+
+def _whisper_cache_key(file_path):
+    """Identifies a transcription by model and the SHA-256 of the audio file, read in 1 MiB blocks."""
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return f"{WHISPER_URL}:{digest.hexdigest()}"
+
+def _cache_whisper_result(key, result):
+    if result is not None:
+        _whisper_cache().set(key, result, expire=WHISPER_CACHE_TTL)
+    return result
+
+def _check_raw_upload(response):
+    """Records from the response to a raw upload whether the endpoint accepts raw audio bodies."""
+    global _raw_upload_supported
+    status = response.status_code
+    if status < 400:
+        _raw_upload_supported = True
+    elif status < 500 and status != 429 and _raw_upload_supported is None:
+        logger.info("Whisper endpoint rejected a raw audio body (%d); using base64 JSON", status)
+        _raw_upload_supported = False
+    return response
+
+@retry("whisper")
+def _post_whisper_raw(file_path):
+    # requests streams the open file as the body, so the audio is never held in memory.
+    with open(file_path, "rb") as f:
+        return _whisper_result(_check_raw_upload(_post(WHISPER_URL, data=f, headers=RAW_AUDIO_HEADERS)))
+
+@retry("whisper")
+def _post_whisper_content(content):
+    return _whisper_result(_check_raw_upload(_post(WHISPER_URL, data=content, headers=RAW_AUDIO_HEADERS)))
+
+@retry("whisper")
+def _post_whisper(payload):
+    return _whisper_result(_post(WHISPER_URL, json=payload))
+
 def whisper(file_path, max_retries=3, retry_delay=2):
     """
-    Sends a WAV file (encoded in base64) to the Whisper endpoint and returns the transcription.
+    Sends a WAV file to the Whisper endpoint and returns the transcription.
+    The file is sent as a raw body, which is a third smaller than base64 JSON, unless the endpoint
+    has rejected that, in which case it is sent base64 encoded.
+    Transcriptions are cached on disk by file contents, so the same audio is only sent once.
+    With WHISPER_BACKEND=local the file is transcribed locally instead (see utils/local_whisper.py).
     
     Args:
         file_path (str): The path to the WAV file.
         max_retries (int): Maximum number of attempts.
-        retry_delay (int): Seconds to wait between attempts.
+        retry_delay (int): Base delay in seconds for the backoff between attempts.
     
     Returns:
         str or None: The transcription text from the Whisper API or None if all attempts fail.
     """
+    if local_whisper is not None:
+        return local_whisper.transcribe(file_path)
+    try:
+        key = _whisper_cache_key(file_path)
+    except OSError as e:
+        logger.error("Error reading WAV file '%s': %s", file_path, e)
+        return None
+    cached = _whisper_cache().get(key)
+    if cached is not None:
+        return cached
+
+    if _raw_upload_supported is not False:
+        result = _post_whisper_raw(file_path, max_retries=max_retries, retry_delay=retry_delay)
+        if result is not None or _raw_upload_supported is not False:
+            return _cache_whisper_result(key, result)
+
     base64string = base64encodewavfile(file_path)
     if base64string is None:
-        logging.error("Failed to encode file: %s", file_path)
+        logger.error("Failed to encode file: %s", file_path)
         return None
     
     payload = {
         "audio": base64string,
     }
-    model_endpoint = "@cf/openai/whisper-large-v3-turbo"
-    url = f"{API_BASE_URL}{model_endpoint}"
-    for attempt in range(max_retries):
-        try:
-            response = requests.post(url, headers=HEADERS, json=payload)
-            logging.info("Whisper attempt %d: response code %d", attempt+1, response.status_code)
-            response.raise_for_status()
-            result = response.json()
-            logging.info("Whisper response: %s", result)
-            final_text = extract_final_text(result)
-            return final_text
-        except Exception as e:
-            logging.error("Error in whisper API call for file '%s' on attempt %d: %s", file_path, attempt+1, e)
-            if attempt < max_retries - 1:
-                time.sleep(retry_delay)
-    return None
+    return _cache_whisper_result(key, _post_whisper(payload, max_retries=max_retries, retry_delay=retry_delay))
+
+def whisper_from_source(file_path, trim_silence=False, max_retries=3, retry_delay=2):
+    """
+    Transcribes any audio or video file FFmpeg can read, without writing a WAV file to disk:
+    the file is converted in memory (see AudioConverter.convert_to_wav_bytes()) and the WAV data is uploaded.
+    Shares the transcription cache with whisper(), keyed on the source file's contents.
+
+    Args:
+        file_path (str): The path to the audio or video file.
+        trim_silence (bool): Remove silences before uploading.
+        max_retries (int): Maximum number of attempts.
+        retry_delay (int): Base delay in seconds for the backoff between attempts.
+
+    Returns:
+        str or None: The transcription text from the Whisper API or None if the conversion or all attempts fail.
+    """
+    if local_whisper is not None:
+        # faster-whisper decodes the source file itself.
+        return local_whisper.transcribe(file_path)
+    try:
+        key = _whisper_cache_key(file_path)
+    except OSError as e:
+        logger.error("Error reading audio file '%s': %s", file_path, e)
+        return None
+    if trim_silence:
+        key += ":trimmed"
+    cached = _whisper_cache().get(key)
+    if cached is not None:
+        return cached
+
+    try:
+        # The output folder is never written to here, but AudioConverter creates it, and a bare file name has none.
+        converter = AudioConverter(input_file=file_path, output_folder=os.path.dirname(file_path) or ".", trim_silence=trim_silence)
+        content = converter.convert_to_wav_bytes()
+    except Exception as e:
+        logger.error("Error converting '%s' to WAV: %s", file_path, e)
+        return None
+
+    if _raw_upload_supported is not False:
+        result = _post_whisper_content(content, max_retries=max_retries, retry_delay=retry_delay)
+        if result is not None or _raw_upload_supported is not False:
+            return _cache_whisper_result(key, result)
+
+    payload = {
+        "audio": b64encode(content).decode("ascii"),
+    }
+    return _cache_whisper_result(key, _post_whisper(payload, max_retries=max_retries, retry_delay=retry_delay))
+
+def async_client():
+    """
+    Returns a new httpx.AsyncClient for the async API functions.
+    A client is bound to the event loop it is used on, so create one per loop and share it between concurrent calls.
+    Requests are multiplexed over a few HTTP/2 connections, so concurrent calls share connections instead of
+    each opening (and TLS-handshaking) its own.
+    """
+    return httpx.AsyncClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=4, max_keepalive_connections=4),
+        timeout=60,
+        headers=HEADERS,
+    )
+
+@retry("llama")
+async def _post_llama_async(prompt, client):
+    return _llama_result(await _post_async(client, LLAMA_URL, json=_llama_payload(prompt)))
+
+async def llama_async(prompt, client, max_retries=3, retry_delay=2):
+    """
+    Async version of llama() using the given httpx.AsyncClient (see async_client()).
+    Shares the response cache with llama().
+
+    Returns:
+        str or None: The response text from the Llama API or None if all attempts fail.
+    """
+    key = _llama_cache_key(prompt)
+    cached = _llama_cache().get(key)
+    if cached is not None:
+        return cached
+    result = await _post_llama_async(prompt, client, max_retries=max_retries, retry_delay=retry_delay)
+    return _cache_llama_result(key, result)
+
+def _read_file(file_path):
+    with open(file_path, "rb") as f:
+        return f.read()
+
+@retry("whisper")
+async def _post_whisper_raw_async(content, client):
+    response = await _post_async(client, WHISPER_URL, content=content, headers=RAW_AUDIO_HEADERS)
+    return _whisper_result(_check_raw_upload(response))
+
+@retry("whisper")
+async def _post_whisper_async(payload, client):
+    return _whisper_result(await _post_async(client, WHISPER_URL, json=payload))
+
+async def whisper_async(file_path, client, max_retries=3, retry_delay=2):
+    """
+    Async version of whisper() using the given httpx.AsyncClient (see async_client()).
+    The file is hashed, read and encoded on worker threads so the event loop is not blocked.
+    Shares the transcription cache with whisper().
+
+    Returns:
+        str or None: The transcription text from the Whisper API or None if all attempts fail.
+    """
+    if local_whisper is not None:
+        return await asyncio.to_thread(local_whisper.transcribe, file_path)
+    try:
+        key = await asyncio.to_thread(_whisper_cache_key, file_path)
+    except OSError as e:
+        logger.error("Error reading WAV file '%s': %s", file_path, e)
+        return None
+    cached = _whisper_cache().get(key)
+    if cached is not None:
+        return cached
+
+    if _raw_upload_supported is not False:
+        content = await asyncio.to_thread(_read_file, file_path)
+        result = await _post_whisper_raw_async(content, client, max_retries=max_retries, retry_delay=retry_delay)
+        if result is not None or _raw_upload_supported is not False:
+            return _cache_whisper_result(key, result)
+
+    base64string = await asyncio.to_thread(base64encodewavfile, file_path)
+    if base64string is None:
+        logger.error("Failed to encode file: %s", file_path)
+        return None
+
+    payload = {
+        "audio": base64string,
+    }
+    result = await _post_whisper_async(payload, client, max_retries=max_retries, retry_delay=retry_delay)
+    return _cache_whisper_result(key, result)
+
+async def whisper_many(file_paths, concurrency=8):
+    """
+    Transcribes several WAV files concurrently over one shared connection pool.
+
+    Args:
+        file_paths (list): Paths of the WAV files.
+        concurrency (int): Maximum number of requests in flight at once.
+
+    Returns:
+        list: The transcription (or None) for each file, in the same order as file_paths.
+    """
+    if local_whisper is not None:
+        return await asyncio.to_thread(local_whisper.transcribe_batch, file_paths)
+    semaphore = asyncio.Semaphore(concurrency)
+    async with async_client() as client:
+        async def bounded(file_path):
+            async with semaphore:
+                return await whisper_async(file_path, client)
+        return await asyncio.gather(*(bounded(file_path) for file_path in file_paths))
+
+def whisper_many_sync(file_paths, concurrency=8):
+    """Blocking wrapper around whisper_many() for callers without an event loop."""
+    return asyncio.run(whisper_many(file_paths, concurrency=concurrency))
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+
     # Example usage for Llama
     prompt = "Write a short story about a llama that goes on a journey to find an orange cloud"
     llama_result = llama(prompt)
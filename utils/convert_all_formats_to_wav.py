@@ -1,11 +1,103 @@
+import concurrent.futures
+import functools
+import json
+import logging
 import os
 import shutil
 import subprocess
-from pydub import AudioSegment
-from pydub.utils import mediainfo
 import re
 import sys
 
+logger = logging.getLogger(__name__)
+
+# Drops leading silence and any silence longer than 0.5s, then normalises loudness, so less audio is uploaded
+# to (and billed by) the transcription API.
+TRIM_SILENCE_FILTER = (
+    "silenceremove=start_periods=1:start_silence=0.3:start_threshold=-40dB"
+    ":stop_periods=-1:stop_silence=0.5:stop_threshold=-40dB,loudnorm"
+)
+
+# Decoder forced for the input, by the codec ffprobe reports for its audio stream.
+_CODEC_MAP = {
+    "opus": "libopus",
+    "aac": "aac",
+    "vorbis": "vorbis",
+    "flac": "flac",
+    "pcm_s16le": "pcm_s16le",
+    "amr_nb": "amrnb",
+    "amr_wb": "amrwb",
+    "wma": "wmav2"
+}
+
+# Output options converting the first audio stream to the 16 kHz mono WAV the Whisper API expects,
+# or copying it when it is already in that format.
+_FFMPEG_TAIL = ('-map', '0:a:0', '-c:a', 'pcm_s16le', '-ar', '16000', '-ac', '1', '-f', 'wav')
+_FFMPEG_COPY_TAIL = ('-map', '0:a:0', '-c:a', 'copy', '-f', 'wav')
+
+# Matches a format line of `ffmpeg -formats`: the 'D', 'E', or 'DE' flags followed by the format name.
+_FMT_RE = re.compile(r'^\s*(D?E?)\s+(\w+)')
+
+# Set once FFmpeg has been found, so later converters skip the check.
+_FFMPEG_OK = False
+
+
+def _check_ffmpeg_installed():
+    """Check if FFmpeg is installed on the system."""
+    global _FFMPEG_OK
+    if _FFMPEG_OK:
+        return
+    try:
+        subprocess.run(['ffmpeg', '-version'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        logger.debug("FFmpeg is installed.")
+        _FFMPEG_OK = True
+    except FileNotFoundError:
+        raise EnvironmentError("FFmpeg is not installed. Please install FFmpeg to use this tool.")
+
+
+@functools.cache
+def _get_supported_formats():
+    """Dynamically fetch the formats supported by FFmpeg. Runs once per process."""
+    try:
+        result = subprocess.run(
+            ['ffmpeg', '-formats'],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True
+        )
+
+        output = result.stdout + result.stderr
+
+        # Parse the output to find supported formats
+        demuxers = set()
+        muxers = set()
+
+        for line in output.splitlines():
+            # Format lines start with " D", "  E" or " DE"; skip everything else without running the regex.
+            if len(line) < 4 or line[0] != ' ' or line[1] not in ' D' or line[2] not in ' E':
+                continue
+            match = _FMT_RE.match(line)
+            if match:
+                flag = match.group(1)  # 'D', 'E', or 'DE'
+                format_name = match.group(2)  # The actual format name
+
+                if 'D' in flag:
+                    demuxers.add(format_name)
+                if 'E' in flag:
+                    muxers.add(format_name)
+
+        # Debug output to verify supported formats
+        # print("Supported demuxers:", demuxers)
+        # print("Supported muxers:", muxers)
+
+        # Frozen, since every converter in the process shares the cached result.
+        return {
+            'demuxers': frozenset(demuxers),
+            'muxers': frozenset(muxers)
+        }
+    except Exception as e:
+        logger.error("Error checking FFmpeg supported formats: %s", e)
+        return None
+
 
 class AudioConverter:
     """
@@ -22,21 +114,26 @@ class AudioConverter:
         Optional: output_folder, id
             Will move the input_file to a folder named the id parameter at the path passed in the output_folder parameter,
              and create the wav file there too.
+        Optional: trim_silence
+            Will remove silences and normalise loudness in the wav file.
+
+    The wav file is always 16 kHz mono pcm_s16le, which is what the Whisper API expects.
 
 
     A class for converting audio and extracting sound from video files to WAV format.
 
     Supports all audio and video formats that FFmpeg can handle.
     Checks which system can support.
-    The class checks the file format of media (via pydub)
+    The class checks the file format of media (via ffprobe)
     attempts to convert it to WAV if the format is supported.
 
     """
 
-    def __init__(self, input_file, output_folder=None, id=None):
+    def __init__(self, input_file, output_folder=None, id=None, trim_silence=False):
         self.input_file = input_file
         self.id = id
-        self.supported_formats = self._get_supported_formats()
+        self.trim_silence = trim_silence
+        self.supported_formats = _get_supported_formats()
 
         # Determine the output folder: if no output_folder is provided and an ID is given, use the input file's directory.
         if output_folder is not None:
@@ -51,9 +148,11 @@ class AudioConverter:
 
         self.file_format = None
         self.audio_codec = None
+        self.channels = None
+        self.sample_rate = None
 
         self.output_file = self._get_output_file_path()
-        self._check_ffmpeg_installed()
+        _check_ffmpeg_installed()
         self.file_format = self._get_file_format()
 
     def __call__(self):
@@ -68,27 +167,31 @@ class AudioConverter:
             The folder where the converted WAV file will be saved. If None, defaults to the input file's directory.
         id : str, optional
             An optional identifier used to create a subfolder for organizing files.
+        trim_silence : bool, optional
+            Remove silences and normalise loudness in the WAV file.
         """
         self.convert_to_wav()
         return self.input_file, self.output_file, self.output_folder, self.output_file_name
 
-    def _check_ffmpeg_installed(self):
-        """Check if FFmpeg is installed on the system."""
-        try:
-            subprocess.run(['ffmpeg', '-version'], stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            print("FFmpeg is installed.")
-        except FileNotFoundError:
-            raise EnvironmentError("FFmpeg is not installed. Please install FFmpeg to use this tool.")
-
     def _create_id_subfolder(self):
         """Creates a subfolder named after the ID and moves the input file to it."""
         self.id_folder = os.path.join(self.output_folder, self.id)
         os.makedirs(self.id_folder, exist_ok=True)
 
+        if os.path.samefile(os.path.dirname(self.input_file) or '.', self.id_folder):
+            # Already in the id folder.
+            self.output_folder = self.id_folder
+            return
+
         new_input_path = os.path.join(self.id_folder, os.path.basename(self.input_file))
-        shutil.move(self.input_file, new_input_path)
+        try:
+            # Atomic rename when both paths are on the same filesystem.
+            os.replace(self.input_file, new_input_path)
+        except OSError:
+            # Only needed across filesystems, where nothing short of copying the file can move it.
+            shutil.move(self.input_file, new_input_path)
         self.input_file = new_input_path
-        print(f"Input file moved to {self.input_file}")
+        logger.debug("Input file moved to %s", self.input_file)
 
         self.output_folder = self.id_folder
 
@@ -100,86 +203,41 @@ class AudioConverter:
         self.output_file_name = os.path.splitext(filename)[0] + '.wav'
         return os.path.join(self.output_folder, self.output_file_name)
 
-    def _get_supported_formats(self):
-        """Dynamically fetch the formats supported by FFmpeg."""
-        try:
-            result = subprocess.run(
-                ['ffmpeg', '-formats'],
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                universal_newlines=True
-            )
-
-            output = result.stdout + result.stderr
-
-            # Parse the output to find supported formats
-            demuxers = set()
-            muxers = set()
-            start_parsing = False
-
-            # Regular expression pattern to match 'D', 'E', or 'DE' anywhere in the line
-            # Regular expression pattern to match 'D', 'E', or 'DE' at the start of the line
-            pattern = re.compile(r'^\s*(D?E?)\s+(\w+)')
-
-            for line in output.splitlines():
-                match = pattern.match(line)
-                if match:
-                    flag = match.group(1)  # 'D', 'E', or 'DE'
-                    format_name = match.group(2)  # The actual format name
-
-                    if 'D' in flag:
-                        demuxers.add(format_name)
-                    if 'E' in flag:
-                        muxers.add(format_name)
-
-            # Debug output to verify supported formats
-            # print("Supported demuxers:", demuxers)
-            # print("Supported muxers:", muxers)
-
-            return {
-                'demuxers': demuxers,
-                'muxers': muxers
-            }
-        except Exception as e:
-            print(f"Error checking FFmpeg supported formats: {e}")
-            return None
-
     def _get_file_format(self):
         """
-        Get the actual file format using the mediainfo function from pydub.
+        Get the actual file format, and the codec, channel count and sample rate of the first audio stream,
+        from a single ffprobe call.
         This method reads the metadata from the file itself and checks if the format matches a known supported format.
         """
         try:
-            info = mediainfo(self.input_file)
-            if 'format_name' in info and info['format_name']:
-                format_list = [fmt.strip().lower() for fmt in info['format_name'].split(',')]
-            else:
-                format_list = []
+            ffprobe_cmd = [
+                'ffprobe', '-v', 'error', '-print_format', 'json', '-show_format', '-show_streams', self.input_file
+            ]
+            ffprobe_output = subprocess.run(ffprobe_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+            meta = json.loads(ffprobe_output.stdout or '{}')
+            format_name = meta.get('format', {}).get('format_name')
+            format_list = [fmt.strip().lower() for fmt in format_name.split(',')] if format_name else []
             
             if format_list:
-                print(f"The file media info matches the following formats: {', '.join(format_list)}")
+                logger.debug("The file media info matches the following formats: %s", ', '.join(format_list))
             else:
-                print("Warning: No media information was found. Proceeding with conversion anyway.")
+                logger.warning("No media information was found. Proceeding with conversion anyway.")
             self.file_formats = format_list
             
-            # Extract audio codec
-            audio_codec = None
-            ffprobe_cmd = ['ffprobe', '-i', self.input_file, '-show_streams', '-select_streams', 'a', '-loglevel', 'error']
-            ffprobe_output = subprocess.run(ffprobe_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-            
-            for line in ffprobe_output.stdout.splitlines():
-                if "codec_name=" in line:
-                    audio_codec = line.split("=")[1].strip()
-                    break
+            # Extract audio codec, channel count and sample rate
+            audio_stream = next((stream for stream in meta.get('streams', []) if stream.get('codec_type') == 'audio'), {})
+            audio_codec = audio_stream.get('codec_name')
+            self.channels = audio_stream.get('channels')
+            self.sample_rate = audio_stream.get('sample_rate')
             
             # #Check if any format from mediainfo matches a supported demuxer format from FFmpeg
             # compatible_formats = [fmt for fmt in format_list if fmt in (fmt.lower() for fmt in self.supported_formats['demuxers'])]
             
             if audio_codec:
-                print(f"Decoding Codec matches: {audio_codec}")
+                logger.debug("Decoding Codec matches: %s", audio_codec)
             self.audio_codec = audio_codec
         except Exception as e:
-            print(f"Unable to determine file decoder: {e}")
+            logger.error("Unable to determine file decoder: %s", e)
 
 
     def convert_to_wav(self):
@@ -187,71 +245,96 @@ class AudioConverter:
         Convert the input file to WAV format or extract audio if it's a video file.
         """
         if self.file_formats is None:
-            print(f"Unrecognized format for {self.input_file}. Trying conversion anyway...")
+            logger.warning("Unrecognized format for %s. Trying conversion anyway...", self.input_file)
 
         self._convert_audio_to_wav()
 
+    def convert_to_wav_bytes(self):
+        """
+        Convert the input file like convert_to_wav(), but return the WAV data instead of writing the output file.
+        The WAV is read from ffmpeg's stdout, so it never touches the disk.
+
+        Raises:
+            subprocess.CalledProcessError: If ffmpeg fails.
+        """
+        cmd = self._ffmpeg_command('pipe:1')
+        logger.debug("Converting with command: %s", cmd)
+        result = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+        logger.debug("Converted %s to WAV data.", self.input_file)
+        return result.stdout
+
+    def _ffmpeg_command(self, output):
+        """Builds the ffmpeg command converting the input file to 16 kHz mono WAV written to output (a path or 'pipe:1')."""
+        #cmd = ['ffmpeg', '-i', self.input_file, '-ar', '16000', '-ac', str(channels), '-b:a', '256k', '-f', 'wav', self.output_file]
+        
+        # cmd = ['ffmpeg', '-y', '-i', self.input_file]
+        # if self.audio_codec in codec_map:
+        #     cmd.extend(['-c:a', codec_map[self.audio_codec]])
+        #cmd.extend(['-ar', '16000', '-ac', str(channels), '-b:a', '256k', '-f', 'wav', self.output_file])
+        #cmd.extend(['-ar', '16000', '-ac', "1", '-b:a', '256k', '-f', 'wav', self.output_file])
+        #cmd.extend(['-c:a', 'pcm_s16le', '-ar', '16000', '-ac', '1', '-b:a', '256k', '-f', 'wav', self.output_file])
+        # cmd.extend(['-c:a', 'pcm_s16le', '-ar', '16000', '-ac', str(channels), '-b:a', '256k', '-f', 'wav', self.output_file])
+        # One thread per ffmpeg so several conversions running side by side do not oversubscribe the CPU.
+        cmd = ['ffmpeg', '-y', '-threads', '1']
+        decoder = _CODEC_MAP.get(self.audio_codec)
+        if decoder:
+            # Force the decoder from the codec map for the input
+            cmd.extend(('-c:a', decoder))
+        cmd.extend(('-i', self.input_file))
+        if self.trim_silence:
+            cmd.extend(('-af', TRIM_SILENCE_FILTER))
+        if (not self.trim_silence and self.audio_codec == 'pcm_s16le'
+                and self.sample_rate == '16000' and self.channels == 1):
+            # Already in the target format, so copy the samples instead of re-encoding them.
+            cmd.extend(_FFMPEG_COPY_TAIL)
+        else:
+            cmd.extend(_FFMPEG_TAIL)
+        cmd.append(output)
+        return cmd
+
     def _convert_audio_to_wav(self):
-        """Convert any audio or video file to WAV format while preserving correct codec handling and channel count."""
+        """Convert any audio or video file to 16 kHz mono WAV while preserving correct codec handling."""
         try:
-            # Detect original channel count
-            ffprobe_cmd = ['ffprobe', '-i', self.input_file, '-show_streams', '-select_streams', 'a', '-loglevel', 'error']
-            ffprobe_output = subprocess.run(ffprobe_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
-            
-            channels = 1  # Default to mono
-            for line in ffprobe_output.stdout.splitlines():
-                if "channels=" in line:
-                    channels = line.split("=")[1].strip()
-                    break
+            cmd = self._ffmpeg_command(self.output_file)
+            logger.debug("Converting with command: %s", cmd)
+            subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+            logger.debug("Converted %s to WAV format.", self.input_file)
         except Exception as e:
-            print(f"Error detecting channel count for {self.input_file}: {e}")
-            channels = 1  # Fallback to mono if detection fails
-
-        # Now proceed with converting the file
-        try:
-            #cmd = ['ffmpeg', '-i', self.input_file, '-ar', '16000', '-ac', str(channels), '-b:a', '256k', '-f', 'wav', self.output_file]
-            
-            # Apply codec-specific handling
-            codec_map = {
-                "opus": "libopus",
-                "aac": "aac",
-                "vorbis": "vorbis",
-                "flac": "flac",
-                "pcm_s16le": "pcm_s16le",
-                "amr_nb": "amrnb",
-                "amr_wb": "amrwb",
-                "wma": "wmav2"
-            }
-            
-            # cmd = ['ffmpeg', '-y', '-i', self.input_file]
-            # if self.audio_codec in codec_map:
-            #     cmd.extend(['-c:a', codec_map[self.audio_codec]])
-            #cmd.extend(['-ar', '16000', '-ac', str(channels), '-b:a', '256k', '-f', 'wav', self.output_file])
-            #cmd.extend(['-ar', '16000', '-ac', "1", '-b:a', '256k', '-f', 'wav', self.output_file])
-            #cmd.extend(['-c:a', 'pcm_s16le', '-ar', '16000', '-ac', '1', '-b:a', '256k', '-f', 'wav', self.output_file])
-            # cmd.extend(['-c:a', 'pcm_s16le', '-ar', '16000', '-ac', str(channels), '-b:a', '256k', '-f', 'wav', self.output_file])
-            cmd = ['ffmpeg', '-y']
-            if self.audio_codec in codec_map:
-                # Force the decoder from the codec map for the input
-                cmd.extend(['-c:a', codec_map[self.audio_codec]])
-            cmd.extend(['-i', self.input_file])
-            cmd.extend(['-c:a', 'pcm_s16le', '-ar', '16000', '-ac', str(channels), '-b:a', '256k', '-f', 'wav', self.output_file])
+            logger.error("Error converting %s to WAV: %s", self.input_file, e)
 
 
+def _convert_one(input_file, output_folder=None, trim_silence=False):
+    """Converts a single file; top-level so it can be sent to a process pool."""
+    return AudioConverter(input_file, output_folder, trim_silence=trim_silence)()
 
 
-
-            
-            print(f"Converting with command: {cmd}")
-            subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
-            print(f"Converted {self.input_file} to WAV format.")
-        except Exception as e:
-            print(f"Error converting {self.input_file} to WAV: {e}")
-
-
+def convert_many(input_files, output_folder=None, workers=None, trim_silence=False):
+    """
+    Converts several files in parallel, one ffmpeg process per file.
+
+    Parameters:
+    ----------
+    input_files : list
+        Paths of the input files (audio or video).
+    output_folder : str, optional
+        The folder where the converted WAV files will be saved. If None, each WAV is saved next to its input.
+    workers : int, optional
+        Number of conversions to run at once. Defaults to the number of CPUs.
+    trim_silence : bool, optional
+        Remove silences and normalise loudness in the WAV files.
+
+    Returns:
+    -------
+    list
+        What AudioConverter returns for each file, in the same order as input_files.
+    """
+    convert = functools.partial(_convert_one, output_folder=output_folder, trim_silence=trim_silence)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers or os.cpu_count()) as executor:
+        return list(executor.map(convert, input_files))
 
 
 if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
     if len(sys.argv) == 2:
         # Only input_file provided
         input_file = sys.argv[1]
@@ -0,0 +1,54 @@
+"""
+Local transcription with faster-whisper, used in place of the Whisper API when WHISPER_BACKEND=local.
+
+The model is loaded on first use and shared by all threads of the process. Files are transcribed with
+a BatchedInferencePipeline, which decodes batches of segments of a file together to keep the GPU busy.
+"""
+import logging
+import os
+import threading
+from faster_whisper import BatchedInferencePipeline, WhisperModel
+
+logger = logging.getLogger(__name__)
+
+LOCAL_WHISPER_MODEL = os.getenv("LOCAL_WHISPER_MODEL", "large-v3-turbo")
+# "auto" uses CUDA when available; "default" keeps the compute type the model was converted with.
+LOCAL_WHISPER_DEVICE = os.getenv("LOCAL_WHISPER_DEVICE", "auto")
+LOCAL_WHISPER_COMPUTE_TYPE = os.getenv("LOCAL_WHISPER_COMPUTE_TYPE", "default")
+LOCAL_WHISPER_BATCH_SIZE = int(os.getenv("LOCAL_WHISPER_BATCH_SIZE", 8))
+
+_pipeline = None
+_pipeline_lock = threading.Lock()
+
+
+def _get_pipeline():
+    global _pipeline
+    with _pipeline_lock:
+        if _pipeline is None:
+            model = WhisperModel(LOCAL_WHISPER_MODEL, device=LOCAL_WHISPER_DEVICE, compute_type=LOCAL_WHISPER_COMPUTE_TYPE)
+            _pipeline = BatchedInferencePipeline(model=model)
+        return _pipeline
+
+
+def transcribe(file_path, batch_size=LOCAL_WHISPER_BATCH_SIZE):
+    """
+    Transcribes an audio or video file locally.
+
+    Args:
+        file_path (str): The path to the file; any format FFmpeg can decode.
+        batch_size (int): Number of segments decoded together.
+
+    Returns:
+        str or None: The transcription text, or None if transcription fails.
+    """
+    try:
+        segments, _ = _get_pipeline().transcribe(file_path, batch_size=batch_size)
+        return "".join(segment.text for segment in segments).strip()
+    except Exception as e:
+        logger.error("Error transcribing '%s' locally: %s", file_path, e)
+        return None
+
+
+def transcribe_batch(file_paths, batch_size=LOCAL_WHISPER_BATCH_SIZE):
+    """Transcribes several files; returns the transcription (or None) for each, in the same order as file_paths."""
+    return [transcribe(file_path, batch_size=batch_size) for file_path in file_paths]
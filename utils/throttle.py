@@ -0,0 +1,98 @@
+import asyncio
+import logging
+import os
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket limiting how often requests may be sent.
+
+    Callers reserve a token and wait until it is due, so concurrent callers queue up
+    behind each other instead of all firing at once.
+
+    Args:
+        rate (float): Tokens added per second.
+        burst (int): Maximum number of tokens that can accumulate.
+    """
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self._tokens = burst
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self):
+        """Takes a token and returns the number of seconds until it is actually available."""
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            self._tokens -= 1
+            return 0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def acquire(self):
+        """Blocks until a token is available."""
+        wait = self._reserve()
+        if wait:
+            time.sleep(wait)
+
+    async def acquire_async(self):
+        """Waits without blocking the event loop until a token is available."""
+        wait = self._reserve()
+        if wait:
+            await asyncio.sleep(wait)
+
+    def set_rate(self, rate):
+        with self._lock:
+            self.rate = rate
+
+
+class AdaptiveController:
+    """
+    Adjusts a TokenBucket's rate from observed response codes (AIMD): the rate is halved on
+    every HTTP 429 and raised by `increase` after `success_threshold` consecutive successes.
+
+    Args:
+        bucket (TokenBucket): The bucket to adjust.
+        min_rate (float): Lower bound for the rate.
+        max_rate (float): Upper bound for the rate.
+        increase (float): Amount added to the rate after a run of successes.
+        success_threshold (int): Number of consecutive successes before increasing the rate.
+    """
+    def __init__(self, bucket, min_rate=0.1, max_rate=None, increase=0.5, success_threshold=20):
+        self.bucket = bucket
+        self.min_rate = min_rate
+        self.max_rate = max_rate if max_rate is not None else bucket.rate
+        self.increase = increase
+        self.success_threshold = success_threshold
+        self._successes = 0
+        self._lock = threading.Lock()
+
+    def observe(self, status_code):
+        with self._lock:
+            if status_code == 429:
+                self._successes = 0
+                rate = max(self.min_rate, self.bucket.rate / 2)
+                logger.warning("Rate limited by API; lowering request rate to %.2f/s", rate)
+                self.bucket.set_rate(rate)
+            elif status_code < 400:
+                self._successes += 1
+                if self._successes >= self.success_threshold:
+                    self._successes = 0
+                    self.bucket.set_rate(min(self.max_rate, self.bucket.rate + self.increase))
+
+    def acquire(self):
+        self.bucket.acquire()
+
+    async def acquire_async(self):
+        await self.bucket.acquire_async()
+
+
+# Shared by every caller in the process, since the API quota is per account rather than per caller.
+API_RATE = float(os.getenv("API_RATE", 5))
+API_BURST = int(os.getenv("API_BURST", 10))
+API_THROTTLE = AdaptiveController(TokenBucket(rate=API_RATE, burst=API_BURST))